@@ -18,74 +18,416 @@ page structure removals. E.g. if we want to watch for a page whose
 content fluctuates too much due to some HTML element we can always
 remove its contents to make results more "stable".
 
+The module uses the first available of the following implementations:
+selectolax (Lexbor backend), lxml (with cssselect), bs4 (BeautifulSoup
+ver4). In case of bs4, if the lxml package is installed, it is used
+as a (much faster) parser backend.
+
 For more documentation please see watchdog.py
 """
 
 try:
-    from bs4 import BeautifulSoup
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+try:
+    import lxml.html
+    from lxml import etree
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    CSSSelector = None
+try:
+    from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer
+    from bs4.element import Tag, PreformattedString
 except ImportError:
     BeautifulSoup = None
+import codecs
+import collections
 import logging
+import re
+
+# a simplified version of HTML5 encoding prescan (<meta charset=...> and
+# <meta http-equiv="Content-Type" content="...; charset=...">)
+META_CHARSET = re.compile(br'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+
+BOMS = ((codecs.BOM_UTF8, 'utf-8'), (codecs.BOM_UTF16_LE, 'utf-16-le'), (codecs.BOM_UTF16_BE, 'utf-16-be'))
+
+# elements without an end tag
+VOID_ELEMENTS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+                           'link', 'meta', 'param', 'source', 'track', 'wbr'))
+
+# elements whose text is not escaped
+RAW_TEXT_ELEMENTS = frozenset(('script', 'style', 'xmp', 'iframe', 'noembed', 'noframes', 'plaintext'))
 
 
 class Query(object):
     def __init__(self, *items):
         self.items = items
+        self.selector = self._css_selector()
+        self._lxml_selector = None
+
+    @property
+    def lxml_selector(self):
+        """
+        A compiled lxml CSSSelector. It is created on the first use so
+        only the backend actually used compiles its selectors.
+        """
+        if self._lxml_selector is None:
+            self._lxml_selector = CSSSelector(self.selector, translator='html')
+        return self._lxml_selector
+
+    @staticmethod
+    def _css_string(value):
+        return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\a ')
+
+    def _css_selector(self):
+        """
+        Translates the query into a CSS selector (query items
+        are joined using the descendant combinator). Ids and classes
+        are matched via quoted attribute selectors so any value
+        from the configuration is safe to use.
+        """
+        parts = []
+        for name, args in self.items:
+            part = name if name else '*'
+            if 'id' in args:
+                part += '[id=%s]' % self._css_string(args['id'])
+            if 'class' in args:
+                part += ''.join('[class~=%s]' % self._css_string(c) for c in args['class'].split())
+            parts.append(part)
+        return ' '.join(parts)
+
+
+def _text(value, parent_name):
+    if parent_name in RAW_TEXT_ELEMENTS:
+        return value
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _start_tag(name, attrs):
+    """
+    arguments:
+    name -- element name
+    attrs -- (name, value) pairs; value may be None (a valueless attribute)
+             or a list (bs4's multi-valued attributes)
+    """
+    parts = ['<', name]
+    for k, v in attrs:
+        if v is None:
+            v = ''
+        elif isinstance(v, (list, tuple)):
+            v = ' '.join(v)
+        parts.append(' %s="%s"' % (k, v.replace('&', '&amp;').replace('"', '&quot;')))
+    parts.append('>')
+    return ''.join(parts)
+
+
+def _end_tag(name):
+    return '' if name in VOID_ELEMENTS else '</%s>' % name
+
+
+# All the backends measure removed contents using the serialization below
+# (instead of their own ones which differ e.g. in escaping or in writing
+# void elements) so the same page has the same size regardless of which
+# backend is installed.
+
+def _bs4_serialize(node, parent_name, out):
+    if isinstance(node, Tag):
+        out.append(_start_tag(node.name, node.attrs.items()))
+        for child in node.contents:
+            _bs4_serialize(child, node.name, out)
+        out.append(_end_tag(node.name))
+    elif isinstance(node, PreformattedString):  # comments, CDATA etc.
+        out.append(node.output_ready())
+    else:
+        out.append(_text(str(node), parent_name))
+
+
+def _lxml_serialize(node, out):
+    if node.tag is etree.Comment:
+        out.append('<!--%s-->' % (node.text or ''))
+    elif not isinstance(node.tag, str):  # e.g. processing instructions
+        out.append(etree.tostring(node, method='html', encoding='unicode', with_tail=False))
+    else:
+        out.append(_start_tag(node.tag, node.attrib.items()))
+        _lxml_serialize_contents(node, out)
+        out.append(_end_tag(node.tag))
+
+
+def _lxml_serialize_contents(node, out):
+    if node.text:
+        out.append(_text(node.text, node.tag))
+    for child in node:
+        _lxml_serialize(child, out)
+        if child.tail:
+            out.append(_text(child.tail, node.tag))
+
+
+def _lexbor_serialize(node, parent_name, out):
+    if node.is_text_node:
+        out.append(_text(node.text(deep=False), parent_name))
+    elif node.tag.startswith('-'):  # comments, doctype
+        out.append(node.html)
+    else:
+        out.append(_start_tag(node.tag, node.attributes.items()))
+        for child in node.iter(include_text=True):
+            _lexbor_serialize(child, node.tag, out)
+        out.append(_end_tag(node.tag))
+
+
+def _encoded_size(pieces, encoding):
+    """
+    Returns size of serialized pieces in the document's encoding
+    (or in characters in case the document is a str).
+    """
+    if encoding is None:
+        return len(''.join(pieces))
+    return len(''.join(pieces).encode(encoding, 'xmlcharrefreplace'))
+
+
+def _valid_encoding(name):
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+
+def detect_encoding(html_code, transport_encoding=None):
+    """
+    Detects encoding of a raw HTML page. The order of precedence
+    is: BOM, transport_encoding (e.g. HTTP Content-Type charset),
+    <meta> element (within first 1024 bytes), UTF-8.
+    """
+    for bom, encoding in BOMS:
+        if html_code.startswith(bom):
+            return encoding
+    if transport_encoding and _valid_encoding(transport_encoding):
+        return _valid_encoding(transport_encoding)
+    srch = META_CHARSET.search(html_code[:1024])
+    if srch and _valid_encoding(srch.group(1).decode('ascii')):
+        return _valid_encoding(srch.group(1).decode('ascii'))
+    return 'utf-8'
+
+
+def make_strainer(ignores):
+    """
+    Creates a SoupStrainer keeping only subtrees which may contain
+    some of the ignored elements (i.e. the ones rooted in an element
+    matching the first item of some query). Returns None in case
+    the whole document must be parsed.
+    """
+    names = set()
+    for ignore in ignores:
+        name = ignore.items[0][0]
+        if not name:
+            return None
+        names.add(name)
+    return SoupStrainer(name=list(names))
+
+
+def make_soup(html_code, parse_only=None, encoding=None):
+    """
+    Parses html_code using the C-backed lxml tree builder
+    if available. Falls back to the pure-Python html.parser.
+    """
+    try:
+        return BeautifulSoup(html_code, 'lxml', parse_only=parse_only, from_encoding=encoding)
+    except FeatureNotFound:
+        return BeautifulSoup(html_code, 'html.parser', parse_only=parse_only, from_encoding=encoding)
 
 
 class PageSize(object):
+    """
+    Applies ignores to a (possibly only partially parsed) soup_document
+    and calculates the resulting size as the original size minus the
+    size of the removed contents.
+    """
 
-    def __init__(self, soup_document, ignores=None):
+    def __init__(self, soup_document, original_size, ignores=None, encoding=None):
         self._ignores = ignores if ignores else []
         self._document = soup_document
+        self._original_size = original_size
+        self._encoding = encoding
+        self._removed_bytes = 0
+        self._build_index()
         self._apply_ignores()
 
+    def _build_index(self):
+        """
+        Indexes all the elements by tag name, id and class in a single pass
+        so each query is resolved without traversing the whole tree again.
+        """
+        self._all = []
+        self._by_tag = collections.defaultdict(list)
+        self._by_id = collections.defaultdict(list)
+        self._by_class = collections.defaultdict(list)
+        for elm in self._document.find_all(True):
+            self._all.append(elm)
+            self._by_tag[elm.name].append(elm)
+            if elm.get('id') is not None:
+                self._by_id[elm['id']].append(elm)
+            for cls in elm.get('class', ()):
+                self._by_class[cls].append(elm)
+
     def _apply_ignores(self):
         for ignore in self._ignores:
             elms = self.find_elem(ignore)
-            for elm in elms:
+            # nested matches first so nothing is subtracted twice
+            for elm in reversed(elms):
+                out = []
+                for child in elm.contents:
+                    _bs4_serialize(child, elm.name, out)
+                self._removed_bytes += _encoded_size(out, self._encoding)
                 elm.clear()
 
+    @staticmethod
+    def _matches(elm, item):
+        name, args = item
+        if name and elm.name != name:
+            return False
+        if 'id' in args and elm.get('id') != args['id']:
+            return False
+        if 'class' in args:
+            elm_classes = elm.get('class', ())
+            return all(c in elm_classes for c in args['class'].split())
+        return True
+
+    def _candidates(self, item):
+        name, args = item
+        if 'id' in args:
+            return self._by_id.get(args['id'], [])
+        elif 'class' in args and args['class'].split():
+            return self._by_class.get(args['class'].split()[0], [])
+        elif name:
+            return self._by_tag.get(name, [])
+        return self._all
+
     def find_elem(self, query):
-        to_srch = [self._document.html]
-        i = 0
-        query_items = query.items[:]
-        while i < len(query_items):
-            query = query_items[i]
-            to_srch_new = []
-            for node in to_srch:
-                to_srch_new.extend(node.find_all(query[0], query[1]))
-            if len(to_srch_new) == 0:
-                break
-            to_srch = to_srch_new
-            i += 1
-        if i == len(query_items):
-            return to_srch
-        else:
-            return []
+        """
+        Finds elements matching the last query item and then verifies
+        the rest of the query by walking up through element's ancestors.
+        Elements already detached from the document (i.e. contained in
+        some previously cleared element) are skipped.
+        """
+        ans = []
+        leaf = query.items[-1]
+        for elm in self._candidates(leaf):
+            if not self._matches(elm, leaf):
+                continue
+            pending = list(query.items[:-1])
+            node = elm
+            while node.parent is not None:
+                node = node.parent
+                if pending and node is not self._document and self._matches(node, pending[-1]):
+                    pending.pop()
+            if not pending and node is self._document:
+                ans.append(elm)
+        return ans
 
     def get_size(self):
-        return len(str(self._document))
-
-
-def page_size(html_code, conf_ignore):
-    if BeautifulSoup is not None:
-        ignores = []
-        if conf_ignore is None:
-            conf_ignore = ()
-        for single_ignore in conf_ignore:
-            tmp = []
-            for ignore_part in single_ignore:
-                args = {}
-                if 'class' in ignore_part:
-                    args['class'] = ignore_part['class']
-                if 'id' in ignore_part:
-                    args['id'] = ignore_part['id']
-                elm_name = ignore_part.get('name', None)
-                tmp.append((elm_name, args))
-            ignores.append(Query(*tmp))
-        pd = PageSize(BeautifulSoup(html_code), ignores=ignores)
-        return pd.get_size()
+        return self._original_size - self._removed_bytes
+
+
+def bs4_page_size(html_code, ignores, encoding=None):
+    """
+    Calculates page size using bs4 (see PageSize). Only subtrees
+    possibly containing ignored elements are parsed.
+    """
+    soup = make_soup(html_code, parse_only=make_strainer(ignores), encoding=encoding)
+    return PageSize(soup, len(html_code), ignores=ignores, encoding=encoding).get_size()
+
+
+def lexbor_page_size(html_code, ignores, encoding=None):
+    """
+    Calculates page size using selectolax's Lexbor parser. Nodes matching
+    the ignores have their contents removed (the same way PageSize does)
+    and the size of the removed contents is subtracted from the original
+    size (i.e. the document is not serialized again).
+    """
+    # Lexbor always decodes bytes as UTF-8
+    tree = LexborHTMLParser(html_code.decode(encoding, 'replace') if encoding else html_code)
+    removed_bytes = 0
+    for ignore in ignores:
+        # nested matches first so no already destroyed node is touched
+        for node in reversed(tree.css(ignore.selector)):
+            out = []
+            children = list(node.iter(include_text=True))
+            for child in children:
+                _lexbor_serialize(child, node.tag, out)
+            removed_bytes += _encoded_size(out, encoding)
+            for child in children:
+                child.decompose()
+    return len(html_code) - removed_bytes
+
+
+def lxml_page_size(html_code, ignores, encoding=None):
+    """
+    Calculates page size using lxml directly (i.e. without bs4 wrapping).
+    Nodes matching the ignores have their contents removed (the same way
+    PageSize does) and the size of the removed contents is subtracted from
+    the original size.
+    """
+    try:
+        doc = lxml.html.fromstring(html_code, parser=lxml.html.HTMLParser(encoding=encoding))
+    except etree.ParserError:
+        # an empty (or whitespace-only) document - nothing to ignore
+        return len(html_code)
+    removed_bytes = 0
+    for ignore in ignores:
+        # nested matches first so nothing is subtracted twice
+        for node in reversed(ignore.lxml_selector(doc)):
+            out = []
+            _lxml_serialize_contents(node, out)
+            removed_bytes += _encoded_size(out, encoding)
+            node.text = None
+            for child in list(node):
+                node.remove(child)
+    return len(html_code) - removed_bytes
+
+
+def compile_ignores(conf_ignore):
+    """
+    Transforms 'pageSizeIgnore' configuration into a list of Query
+    objects. This is expected to be done once per configuration load.
+    """
+    ignores = []
+    if conf_ignore is None:
+        conf_ignore = ()
+    for single_ignore in conf_ignore:
+        tmp = []
+        for ignore_part in single_ignore:
+            args = {}
+            if 'class' in ignore_part:
+                args['class'] = ignore_part['class']
+            if 'id' in ignore_part:
+                args['id'] = ignore_part['id']
+            elm_name = ignore_part.get('name', None)
+            tmp.append((elm_name, args))
+        ignores.append(Query(*tmp))
+    return ignores
+
+
+def page_size(html_code, ignores, transport_encoding=None):
+    """
+    Calculates size of html_code with contents of ignored elements removed.
+    The size of removed contents is measured in the page's encoding so the
+    result is in bytes (or in characters in case html_code is a str).
+
+    arguments:
+    html_code -- a raw HTML page
+    ignores -- a list of Query objects (see compile_ignores)
+    transport_encoding -- an encoding specified by the HTTP response (if any)
+    """
+    if not ignores:
+        return len(html_code)
+    encoding = detect_encoding(html_code, transport_encoding) if isinstance(html_code, bytes) else None
+    if LexborHTMLParser is not None:
+        return lexbor_page_size(html_code, ignores, encoding)
+    elif CSSSelector is not None:
+        return lxml_page_size(html_code, ignores, encoding)
+    elif BeautifulSoup is not None:
+        return bs4_page_size(html_code, ignores, encoding)
     else:
-        logging.getLogger(__name__).warning('Module bs4 (BeautifulSoup ver4) not found. Returning raw page size.')
+        logging.getLogger(__name__).warning('None of selectolax, lxml + cssselect, bs4 (BeautifulSoup ver4) found. '
+                                            'Returning raw page size.')
         return len(html_code)
@@ -0,0 +1,174 @@
+# Copyright 2015 Institute Of The Czech National Corpus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Checks that all the available page_size backends (bs4, lxml, Lexbor)
+remove the same contents. The contents of ignored elements are measured
+using a serialization shared by all the backends so in the test page,
+they are written in that form (only &, <, > escaped in text, double-quoted
+attributes, void elements without a slash). The rest of the page is never
+serialized again so it may contain anything (implied tbody, unclosed
+elements etc.). Please note that the parsers may still build different
+trees inside an ignored element (e.g. Lexbor adds an implied tbody to
+a table as HTML5 requires) so such markup is written explicitly there.
+
+Run: python -m unittest test_pagesize
+"""
+
+import codecs
+import unittest
+
+import pagesize
+
+
+MISC = 'a&lt;b&amp;c<br>d e<!-- note --><table><tbody><tr><td>x</td></tr></tbody></table>'
+
+PAGE = (
+    '<html><head></head><body>'
+    '<div class="foo">A<span id="x">BB</span>'
+    '<div class="foo bar">CCC<b>DDDD</b></div></div>'
+    '<p class="bar">EEEEE</p>'
+    '<form id="credentials">FFFFFF</form>'
+    '<div class="col-md:6"><i id="a.b">GGGGGGG</i></div>'
+    '<section><b id="1x">HHHHHHHH</b></section>'
+    '<div class="misc">' + MISC + '</div>'
+    '<table><tr><td>T&amp;U<br></td></tr></table><hr/>'
+    '<p>unclosed &copy; 2015'
+    '</body></html>')
+
+
+def backends():
+    ans = []
+    if pagesize.BeautifulSoup is not None:
+        ans.append(('bs4', pagesize.bs4_page_size))
+    if pagesize.CSSSelector is not None:
+        ans.append(('lxml', pagesize.lxml_page_size))
+    if pagesize.LexborHTMLParser is not None:
+        ans.append(('lexbor', pagesize.lexbor_page_size))
+    return ans
+
+
+def removed(*parts):
+    return len(PAGE.encode('utf-8')) - sum(len(p.encode('utf-8')) for p in parts)
+
+
+class PageSizeBackendsTest(unittest.TestCase):
+
+    def assert_size(self, conf_ignore, expected):
+        ignores = pagesize.compile_ignores(conf_ignore)
+        available = backends()
+        if not available:
+            self.skipTest('no page_size backend installed')
+        for name, fn in available:
+            with self.subTest(backend=name):
+                self.assertEqual(expected, fn(PAGE.encode('utf-8'), ignores))
+
+    def test_no_match(self):
+        self.assert_size([[{'name': 'nonexistent'}]], removed())
+
+    def test_nested_query(self):
+        self.assert_size([[{'name': 'div', 'class': 'foo'}, {'name': 'span', 'id': 'x'}]],
+                         removed('BB'))
+
+    def test_nested_matches(self):
+        # the inner div.foo is a part of the outer one's contents
+        self.assert_size([[{'name': 'div', 'class': 'foo'}]],
+                         removed('A<span id="x">BB</span><div class="foo bar">CCC<b>DDDD</b></div>'))
+
+    def test_overlapping_queries(self):
+        self.assert_size([[{'name': 'div', 'class': 'bar'}, {'name': 'b'}],
+                          [{'name': 'div', 'class': 'foo'}]],
+                         removed('A<span id="x">BB</span><div class="foo bar">CCC<b></b></div>', 'DDDD'))
+
+    def test_class_only_query(self):
+        self.assert_size([[{'class': 'bar'}]],
+                         removed('CCC<b>DDDD</b>', 'EEEEE'))
+
+    def test_multiple_classes(self):
+        self.assert_size([[{'class': 'bar foo'}]],
+                         removed('CCC<b>DDDD</b>'))
+
+    def test_id_only_query(self):
+        self.assert_size([[{'id': 'credentials'}]], removed('FFFFFF'))
+
+    def test_special_characters(self):
+        self.assert_size([[{'name': 'div', 'class': 'col-md:6'}, {'id': 'a.b'}],
+                          [{'id': '1x'}]],
+                         removed('GGGGGGG', 'HHHHHHHH'))
+
+    def test_entities_void_elements_and_tables(self):
+        self.assert_size([[{'name': 'div', 'class': 'misc'}]], removed(MISC))
+
+    def test_table_outside_ignored(self):
+        self.assert_size([[{'name': 'td'}]], removed('x', 'T&amp;U<br>'))
+
+
+class PageSizeEncodingTest(unittest.TestCase):
+    """
+    Removed contents must be measured in the page's own encoding.
+    """
+
+    def assert_size(self, html_code, expected, transport_encoding=None):
+        ignores = pagesize.compile_ignores([[{'name': 'div', 'class': 'foo'}]])
+        encoding = pagesize.detect_encoding(html_code, transport_encoding)
+        available = backends()
+        if not available:
+            self.skipTest('no page_size backend installed')
+        for name, fn in available:
+            with self.subTest(backend=name):
+                self.assertEqual(expected, fn(html_code, ignores, encoding))
+
+    def make_page(self, head, inner, encoding):
+        return ('<html><head>%s</head><body><div class="foo">%s</div><p>\u017eluva</p></body></html>'
+                % (head, inner)).encode(encoding)
+
+    def test_meta_charset(self):
+        inner = '\u017elu\u0165ou\u010dk\u00fd k\u016f\u0148'
+        html_code = self.make_page('<meta charset="windows-1250">', inner, 'windows-1250')
+        self.assertEqual('cp1250', pagesize.detect_encoding(html_code))
+        self.assert_size(html_code, len(html_code) - len(inner.encode('windows-1250')))
+
+    def test_meta_http_equiv(self):
+        inner = '\u017elu\u0165ou\u010dk\u00fd'
+        html_code = self.make_page('<meta http-equiv="Content-Type" content="text/html; charset=iso-8859-2">',
+                                   inner, 'iso-8859-2')
+        self.assert_size(html_code, len(html_code) - len(inner.encode('iso-8859-2')))
+
+    def test_utf8_default(self):
+        inner = '\u017elu\u0165ou\u010dk\u00fd\u00a0k\u016f\u0148'
+        html_code = self.make_page('', inner, 'utf-8')
+        self.assertEqual('utf-8', pagesize.detect_encoding(html_code))
+        self.assert_size(html_code, len(html_code) - len(inner.encode('utf-8')))
+
+    def test_transport_encoding(self):
+        inner = '\u017elu\u0165ou\u010dk\u00fd'
+        html_code = self.make_page('', inner, 'windows-1250')
+        self.assert_size(html_code, len(html_code) - len(inner.encode('windows-1250')),
+                         transport_encoding='windows-1250')
+
+    def test_bom(self):
+        html_code = codecs.BOM_UTF8 + self.make_page('<meta charset="windows-1250">', 'x', 'utf-8')
+        self.assertEqual('utf-8', pagesize.detect_encoding(html_code, 'windows-1250'))
+
+    def test_str_page(self):
+        if not backends():
+            self.skipTest('no page_size backend installed')
+        inner = '\u017elu\u0165ou\u010dk\u00fd'
+        html_code = self.make_page('', inner, 'utf-8').decode('utf-8')
+        self.assertEqual(len(html_code) - len(inner),
+                         pagesize.page_size(html_code, pagesize.compile_ignores([[{'class': 'foo'}]])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+# Copyright 2015 Institute Of The Czech National Corpus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests of watchdog's request measuring (against a local HTTP server)
+and repeating of failed tests.
+
+Run: python -m unittest test_watchdog
+"""
+
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import pagesize
+import watchdog
+
+
+PAGE = b'<html><head></head><body><div class="foo">' + b'x' * 1000 + b'</div><p>keep</p></body></html>'
+
+BIG_SIZE = 3 * 1024 * 1024
+
+
+def backend_available():
+    return any(x is not None for x in (pagesize.LexborHTMLParser, pagesize.CSSSelector, pagesize.BeautifulSoup))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, code, body, headers=()):
+        self.send_response(code)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.seen_headers.append(dict(self.headers))
+        if self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self._send(304, b'', [('ETag', '"v1"')])
+            else:
+                self._send(200, PAGE, [('ETag', '"v1"'), ('Content-Type', 'text/html; charset=utf-8')])
+        elif self.path == '/page':
+            self._send(200, PAGE)
+        elif self.path == '/big':
+            self._send(200, b'a' * BIG_SIZE)
+        else:
+            self._send(404, b'not found')
+
+    def log_message(self, *args):
+        pass
+
+
+class MeasureReqTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.server.seen_headers = []
+        cls.url = 'http://127.0.0.1:%d/{path}' % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        watchdog.etag_cache.clear()
+        watchdog.size_cache.clear()
+        self.server.seen_headers[:] = []
+        self.ignores = pagesize.compile_ignores([[{'name': 'div', 'class': 'foo'}]])
+
+    def measure(self, path, orig_size=None, threshold=None, ignores=None):
+        return watchdog.measure_req(url=self.url, url_params={'path': path}, orig_size=orig_size,
+                                    resp_size_threshold=threshold, resp_time_threshold=5.0,
+                                    ignores=ignores)
+
+    def test_etag_revalidation(self):
+        if not backend_available():
+            self.skipTest('no page_size backend installed')
+        with mock.patch.object(watchdog.pagesize, 'page_size', wraps=pagesize.page_size) as page_size:
+            first = self.measure('etag', len(PAGE) - 1000, 0.1, self.ignores)
+            second = self.measure('etag', len(PAGE) - 1000, 0.1, self.ignores)
+        self.assertEqual((200, []), (first['code'], first['errors']))
+        self.assertEqual((304, []), (second['code'], second['errors']))
+        self.assertEqual(len(PAGE) - 1000, first['size'])
+        self.assertEqual(first['size'], second['size'])
+        self.assertEqual('"v1"', self.server.seen_headers[1].get('If-None-Match'))
+        self.assertEqual(1, page_size.call_count)
+
+    def test_identical_body_is_not_parsed_again(self):
+        with mock.patch.object(watchdog.pagesize, 'page_size', return_value=123) as page_size:
+            first = self.measure('page', 123, 0.1, self.ignores)
+            second = self.measure('page', 123, 0.1, self.ignores)
+        self.assertEqual(123, first['size'])
+        self.assertEqual(123, second['size'])
+        self.assertEqual(1, page_size.call_count)
+
+    def test_no_size_check_skips_parsing(self):
+        with mock.patch.object(watchdog.pagesize, 'page_size') as page_size:
+            ans = self.measure('page', ignores=self.ignores)
+        self.assertEqual(len(PAGE), ans['size'])
+        page_size.assert_not_called()
+
+    def test_body_limit_with_size_check(self):
+        ans = self.measure('big', orig_size=100, threshold=0.5)
+        self.assertEqual(['Response body exceeds %d bytes.' % watchdog.MIN_BODY_LIMIT], ans['errors'])
+        self.assertLess(ans['size'], BIG_SIZE)
+
+    def test_no_body_limit_error_without_size_check(self):
+        ans = self.measure('big')
+        self.assertEqual([], ans['errors'])
+        self.assertEqual(BIG_SIZE, ans['size'])
+
+    def test_drain_cap(self):
+        with mock.patch.object(watchdog, 'MAX_DRAIN_SIZE', 1024 * 1024):
+            ans = self.measure('big')
+        self.assertEqual([], ans['errors'])
+        self.assertGreater(ans['size'], 1024 * 1024)
+        self.assertLess(ans['size'], BIG_SIZE)
+
+    def test_http_error(self):
+        ans = self.measure('missing')
+        self.assertEqual(404, ans['code'])
+        self.assertEqual(['HTTP status code 404'], ans['errors'])
+
+
+class ReadBodyTest(unittest.TestCase):
+
+    class Response(object):
+        def __init__(self, size):
+            self._size = size
+
+        def iter_content(self, chunk_size):
+            for i in range(0, self._size, chunk_size):
+                yield b'a' * min(chunk_size, self._size - i)
+
+    def test_within_limit(self):
+        self.assertEqual((b'a' * 1000, True), watchdog.read_body(self.Response(1000), 1000))
+
+    def test_limit_exceeded(self):
+        body, complete = watchdog.read_body(self.Response(10 * watchdog.READ_CHUNK_SIZE), watchdog.READ_CHUNK_SIZE)
+        self.assertFalse(complete)
+        self.assertEqual(2 * watchdog.READ_CHUNK_SIZE, len(body))
+
+
+class RunTestTest(unittest.TestCase):
+
+    PASSED = {'time': 10., 'code': 200, 'size': 100, 'errors': []}
+
+    TIMEOUT = {'time': None, 'code': None, 'size': None, 'errors': ['timeout']}
+
+    FAILED = {'time': 10., 'code': 500, 'size': 100, 'errors': ['HTTP status code 500']}
+
+    def setUp(self):
+        self.test = {'title': 'test', 'url': 'http://localhost/', 'responseTimeLimit': 5.0,
+                     '_ignores': [], '_gen_callables': {}}
+
+    def run_test(self, *answers, **config):
+        with mock.patch.object(watchdog, 'measure_req', side_effect=answers) as measure_req:
+            result = watchdog.run_test(self.test, config)
+        return result, measure_req.call_count
+
+    def test_passed(self):
+        result, num_calls = self.run_test(self.PASSED)
+        self.assertEqual(dict(self.PASSED, title='test'), result)
+        self.assertEqual(1, num_calls)
+
+    def test_passed_after_retry(self):
+        result, num_calls = self.run_test(self.TIMEOUT, self.PASSED)
+        self.assertEqual([], result['errors'])
+        self.assertEqual(1, result['failedAttempts'])
+        self.assertEqual(['timeout'], result['retriedErrors'])
+        self.assertEqual(2, num_calls)
+
+    def test_first_failure_is_reported(self):
+        result, num_calls = self.run_test(self.TIMEOUT, self.FAILED)
+        self.assertEqual(['timeout'], result['errors'])
+        self.assertEqual(2, result['failedAttempts'])
+        self.assertNotIn('retriedErrors', result)
+
+    def test_num_repeat(self):
+        result, num_calls = self.run_test(self.FAILED, self.FAILED, self.FAILED, numRepeat=3)
+        self.assertEqual(3, result['failedAttempts'])
+        self.assertEqual(3, num_calls)
+
+    def test_ignored(self):
+        self.test = {'title': 'test', 'ignore': True}
+        result, num_calls = self.run_test()
+        self.assertEqual({'errors': [], 'title': 'test', 'omitted': True}, result)
+        self.assertEqual(0, num_calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
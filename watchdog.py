@@ -1,4 +1,4 @@
-#!/usr/bin/python2
+#!/usr/bin/python3
 
 # Copyright 2015 Institute Of The Czech National Corpus
 #
@@ -19,12 +19,18 @@ A simple script for testing websites availability.
 Results are written into a defined log file and in case of errors,
 an e-mail is sent to a defined list of recipients.
 
+The script requires Python 3 and the requests package. Optionally, orjson
+is used to load the configuration faster. To measure page size with some
+page parts ignored (pageSizeIgnore), one of selectolax, lxml + cssselect,
+bs4 (BeautifulSoup ver4) is needed (see pagesize.py).
+
 A configuration file example:
 
 {
     "logPath": "./watchdog.log",
     "debug": false,
     "pageSizeThreshold": 0.7,
+    "numRepeat": 2,
     "mailRecipients":["user1@localhost", "user2@localhost"],
     "smtpServer": "mail.localdomain",
     "mailSender": "watchdog@localdomain",
@@ -47,22 +53,105 @@ A configuration file example:
 }
 """
 
-import urllib
-import urllib2
-import datetime
+import urllib.parse
+import hashlib
+import importlib
 import time
 import json
 import sys
 import os
+import queue
 import logging
 from logging import handlers
 import smtplib
 from email.mime.text import MIMEText
+from concurrent import futures
+
+import requests
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 import pagesize
 
+MAX_WORKERS = 32
+
+# the minimum limit of a response body size (applies only to tests with size check)
+MIN_BODY_LIMIT = 2 * 1024 * 1024
+
+# the max. number of bytes read from a response body of a test without size check
+MAX_DRAIN_SIZE = 64 * 1024 * 1024
+
+READ_CHUNK_SIZE = 65536
+
+# how many times a failing test is tried before it is reported
+DEFAULT_NUM_REPEAT = 2
+
+# a shared session allows connections to be reused (keep-alive) across tests
+session = requests.Session()
+session.headers['Accept-Encoding'] = 'gzip, deflate'
+session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS))
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS))
+
+# URL => (ETag, measured page size) of the last response containing an ETag
+etag_cache = {}
+
+# URL => (body hash, measured page size) of the last response
+size_cache = {}
+
+
+def read_body(resp, limit):
+    """
+    Reads a response body in chunks up to a defined limit.
+
+    arguments:
+    resp -- a streamed requests' response
+    limit -- max. number of bytes to be read
+
+    returns:
+    a 2-tuple (body, complete) where complete is False in case the limit was exceeded
+    """
+    buf = bytearray()
+    for chunk in resp.iter_content(READ_CHUNK_SIZE):
+        buf.extend(chunk)
+        if len(buf) > limit:
+            return bytes(buf), False
+    return bytes(buf), True
+
 
-def measure_req(url, url_params, orig_size, resp_size_threshold, resp_time_threshold, conf_ignore):
+def drain_body(resp, limit):
+    """
+    Reads a response body in chunks without keeping it. The reading
+    stops once the limit is exceeded.
+
+    arguments:
+    resp -- a streamed requests' response
+    limit -- max. number of bytes to be read
+
+    returns:
+    body size (or the number of bytes read in case the limit was exceeded)
+    """
+    size = 0
+    for chunk in resp.iter_content(READ_CHUNK_SIZE):
+        size += len(chunk)
+        if size > limit:
+            break
+    return size
+
+
+def get_charset(resp):
+    """
+    Returns a charset specified in response's Content-Type header (or None)
+    """
+    for param in resp.headers.get('Content-Type', '').split(';')[1:]:
+        k, _, v = param.partition('=')
+        if k.strip().lower() == 'charset':
+            return v.strip().strip('"\'')
+    return None
+
+
+def measure_req(url, url_params, orig_size, resp_size_threshold, resp_time_threshold, ignores):
     """
     Performs a request and measures required properties.
 
@@ -72,84 +161,186 @@ def measure_req(url, url_params, orig_size, resp_size_threshold, resp_time_thres
     orig_size -- expected response (body) size
     resp_size_threshold -- a float number between 0 and 1 specifying how big difference in size
                            is tolerated (calc: abs(actual - expected) / expected)
-    resp_time_threshold -- a float number between 0 and 1 specifying how big difference in response
-                           time (compared to defined one) is tolerated (calc: actual - expected)
-    conf_ignore -- HTML elements to be ignored (see module's docstrings for syntax)
+    resp_time_threshold -- max. response time in seconds
+    ignores -- HTML elements to be ignored (compiled 'pageSizeIgnore', see pagesize.compile_ignores)
 
     returns:
     a dictionary containing time, code, size, errors
     """
-    start = datetime.datetime.now()
+    start = time.monotonic()
     try:
-        nf = urllib2.urlopen(url.format(**url_params), timeout=10)
-        page = nf.read()
-        end = datetime.datetime.now()
-        delta = end - start
-        current_size = pagesize.page_size(page, conf_ignore)
-
-        ans = {
-            'time': delta.seconds / 1000. + delta.microseconds / 1000.,
-            'code': nf.getcode(),
-            'size': current_size,
-            'errors': []
-        }
-        if orig_size is not None and resp_size_threshold is not None:
-            size_diff = get_size_diff(orig=orig_size, current=current_size)
-            if size_diff > resp_size_threshold:
-                ans['errors'].append('Response body changed by %01.1f%% (threshold = %01.1f%%).' % (size_diff * 100,
-                                                                                            resp_size_threshold * 100))
-        if ans['time'] > resp_time_threshold * 1000:
-            perc = ans['time'] / float(resp_time_threshold) * 100
-            ans['errors'].append('Loading time limit exceeded by %01.1f%%.' % perc)
-        if int(nf.getcode()) / 100 == 4:
-            ans['errors'].append('HTTP status code %s' % nf.getcode())
-        nf.close()
+        full_url = url.format(**url_params)
+        cached = etag_cache.get(full_url)
+        headers = {'If-None-Match': cached[0]} if cached else {}
+        size_check = orig_size is not None and resp_size_threshold is not None
+        with session.get(full_url, headers=headers, timeout=10, stream=True) as resp:
+            if size_check:
+                body_limit = max(int(orig_size * (1 + resp_size_threshold) * 2), MIN_BODY_LIMIT)
+                page, complete = read_body(resp, body_limit)
+                body_size = len(page)
+            else:
+                # only the size of the body is needed here (a partial one in case
+                # of an extremely large body is still good enough)
+                page, complete = None, True
+                body_size = drain_body(resp, MAX_DRAIN_SIZE)
+            elapsed_ms = (time.monotonic() - start) * 1000.
+            if resp.status_code == 304 and cached:
+                current_size = cached[1]
+            else:
+                if not complete or not size_check or not ignores:
+                    # the page structure is not needed here
+                    current_size = body_size
+                else:
+                    body_hash = hashlib.blake2b(page, digest_size=16).digest()
+                    cached_size = size_cache.get(full_url)
+                    if cached_size is not None and cached_size[0] == body_hash:
+                        current_size = cached_size[1]
+                    else:
+                        current_size = pagesize.page_size(page, ignores, transport_encoding=get_charset(resp))
+                        size_cache[full_url] = (body_hash, current_size)
+                if complete and 'ETag' in resp.headers:
+                    etag_cache[full_url] = (resp.headers['ETag'], current_size)
+
+            ans = {
+                'time': elapsed_ms,
+                'code': resp.status_code,
+                'size': current_size,
+                'errors': []
+            }
+            if size_check:
+                if not complete:
+                    ans['errors'].append('Response body exceeds %d bytes.' % body_limit)
+                else:
+                    size_diff = abs(orig_size - current_size) / orig_size
+                    if size_diff > resp_size_threshold:
+                        ans['errors'].append('Response body changed by %01.1f%% (threshold = %01.1f%%).' % (
+                            size_diff * 100, resp_size_threshold * 100))
+            if ans['time'] > resp_time_threshold * 1000:
+                perc = (ans['time'] / (resp_time_threshold * 1000.) - 1) * 100
+                ans['errors'].append('Loading time limit exceeded by %01.1f%%.' % perc)
+            if resp.status_code // 100 in (4, 5):
+                ans['errors'].append('HTTP status code %s' % resp.status_code)
     except Exception as e:
         ans = {'time': None, 'code': None, 'size': None, 'errors': ['%s' % e]}
     return ans
 
 
-def generate_params(gen):
+def compile_generators(gen):
     """
-    Generates URL parameters using defined 'generators' (= module+function)
+    Resolves defined 'generators' (= module+function) to callables
 
     arguments:
-    gen -- a dictionary: param_name => (gen_module, gen_function)
+    gen -- a dictionary: param_name => 'gen_module.gen_function' (or just
+           'gen_function' in case of a function defined in this module)
 
     returns:
-    a dictionary param_name => generated_value
+    a dictionary param_name => (function, quote_output)
     """
     output = {}
     if gen is not None:
         for k, g in gen.items():
             if '.' in g:
                 mod, fn = g.rsplit('.', 1)
-                m = __import__(mod, fromlist=[])
-                output[k] = urllib.quote(getattr(m, fn)())
+                output[k] = (getattr(importlib.import_module(mod), fn), True)
             else:
-                output[k] = apply(getattr(sys.modules[__name__], g))
+                output[k] = (getattr(sys.modules[__name__], g), False)
     return output
 
 
-def load_config(path):
-    return json.load(open(path))
+def generate_params(gen):
+    """
+    Generates URL parameters using compiled 'generators'
+
+    arguments:
+    gen -- a dictionary: param_name => (function, quote_output) (see compile_generators)
+
+    returns:
+    a dictionary param_name => generated_value
+    """
+    output = {}
+    for k, (fn, quote_output) in gen.items():
+        output[k] = urllib.parse.quote(fn()) if quote_output else fn()
+    return output
 
 
-def get_size_diff(orig, current):
-    assert orig is not None
-    assert current is not None
-    orig = float(orig)
-    current = float(current)
-    return abs(orig - current) / orig
+def load_config(path):
+    with open(path, 'rb') as fr:
+        data = fr.read()
+    config = orjson.loads(data) if orjson is not None else json.loads(data)
+    for test in config['tests']:
+        if not test.get('ignore', False):
+            # an ignored test may refer to no longer available generators etc.
+            test['_ignores'] = pagesize.compile_ignores(test.get('pageSizeIgnore', None))
+            test['_gen_callables'] = compile_generators(test.get('generator', None))
+    return config
 
 
 def setup_logger(path, debug=False):
-    # logging setup
+    """
+    Sets up logging to a rotating file. Records are only enqueued by the
+    calling threads and written by a background QueueListener.
+
+    returns:
+    a started QueueListener (to be stopped once logging is done)
+    """
     logger = logging.getLogger('')
     hdlr = handlers.RotatingFileHandler(path, maxBytes=(1 << 23), backupCount=50)
     hdlr.setFormatter(logging.Formatter('%(asctime)s [%(name)s] %(levelname)s: %(message)s'))
-    logger.addHandler(hdlr)
+    log_queue = queue.Queue(-1)
+    logger.addHandler(handlers.QueueHandler(log_queue))
     logger.setLevel(logging.INFO if not debug else logging.DEBUG)
+    listener = handlers.QueueListener(log_queue, hdlr)
+    listener.start()
+    return listener
+
+
+def run_test(test, config):
+    """
+    Runs a single test (unless it is configured to be ignored). A failing
+    test is repeated (up to 'numRepeat' times). In case all the attempts
+    fail, the first failure is reported. In case some repeated attempt
+    passes, its result is reported along with the number of failed
+    attempts and the errors of the first one ('retriedErrors').
+
+    arguments:
+    test -- a test configuration (an item of config['tests'])
+    config -- the whole configuration (used for global defaults)
+
+    returns:
+    a dictionary containing title, errors and measured properties
+    """
+    result = {'errors': [], 'title': test['title']}
+    if not test.get('ignore', False):
+        page_size_threshold = test.get('pageSizeThreshold', None)
+        if page_size_threshold is None:
+            page_size_threshold = config.get('pageSizeThreshold', None)
+
+        first_failure = None
+        num_failed = 0
+        for _ in range(max(1, config.get('numRepeat', DEFAULT_NUM_REPEAT))):
+            url_params = generate_params(test['_gen_callables'])
+            ans = measure_req(url=test['url'],
+                              url_params=url_params,
+                              orig_size=test.get('size', None),
+                              resp_size_threshold=page_size_threshold,
+                              resp_time_threshold=test['responseTimeLimit'],
+                              ignores=test['_ignores'])
+            if len(ans['errors']) == 0:
+                break
+            num_failed += 1
+            if first_failure is None:
+                first_failure = ans
+        if len(ans['errors']) > 0:
+            result.update(first_failure)
+        else:
+            result.update(ans)
+            if first_failure is not None:
+                result['retriedErrors'] = first_failure['errors']
+        if num_failed > 0:
+            result['failedAttempts'] = num_failed
+    else:
+        result['omitted'] = True
+    return result
 
 
 def send_email(failed_tests, server, sender, recipients):
@@ -163,19 +354,20 @@ def send_email(failed_tests, server, sender, recipients):
     text += '\n\nYour watchdog.py'
     s = smtplib.SMTP(server)
 
-    for recipient in recipients:
-        msg = MIMEText(text)
-        msg['Subject'] = "Web watchdog error report from %s" % time.strftime('%Y-%m-%d %H:%M:%S')
-        msg['From'] = sender
-        msg['To'] = recipient
-        try:
-            s.sendmail(sender, [recipient], msg.as_string())
-        except Exception as ex:
-            log.error('Failed to send an e-email to <%s>, error: %r' % (recipient, ex))
+    msg = MIMEText(text)
+    msg['Subject'] = "Web watchdog error report from %s" % time.strftime('%Y-%m-%d %H:%M:%S')
+    msg['From'] = sender
+    msg['To'] = 'undisclosed-recipients:;'
+    msg['Bcc'] = ', '.join(recipients)
+    try:
+        refused = s.send_message(msg, from_addr=sender, to_addrs=recipients)
+        for recipient, err in refused.items():
+            log.error('Failed to send an e-email to <%s>, error: %r' % (recipient, err))
+    except Exception as ex:
+        log.error('Failed to send an e-email to <%s>, error: %r' % ('>, <'.join(recipients), ex))
     s.quit()
 
 if __name__ == '__main__':
-    num_repeat = 2
     log = logging.getLogger(os.path.basename(__file__))
     failed_tests = []
 
@@ -186,31 +378,25 @@ if __name__ == '__main__':
         config_file = sys.argv[1]
     config = load_config(config_file)
 
-    setup_logger(config['logPath'], config['debug'])
-
-    for test in config['tests']:
-        result = {'errors': [], 'title': test['title']}
-        if not test.get('ignore', False):
-            page_size_threshold = test.get('pageSizeThreshold', None)
-            if page_size_threshold is None:
-                page_size_threshold = config.get('pageSizeThreshold', None)
-
-            url_params = generate_params(test.get('generator', None))
-            result.update(measure_req(url=test['url'],
-                                      url_params=url_params,
-                                      orig_size=test.get('size', None),
-                                      resp_size_threshold=page_size_threshold,
-                                      resp_time_threshold=test['responseTimeLimit'],
-                                      conf_ignore=test.get('pageSizeIgnore', None)))
-        else:
-            result['omitted'] = True
-        if len(result['errors']) > 0:
-            log.error(json.dumps(result))
-        else:
-            log.info(json.dumps(result))
+    log_listener = setup_logger(config['logPath'], config['debug'])
+    try:
+        tests = config['tests']
+        with futures.ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(tests)))) as executor:
+            pending = [executor.submit(run_test, test, config) for test in tests]
+            # results are processed in the configuration order (to keep the log and the report stable)
+            for future in pending:
+                result = future.result()
+                if len(result['errors']) > 0:
+                    log.error(json.dumps(result))
+                elif result.get('failedAttempts', 0) > 0:
+                    log.warning(json.dumps(result))
+                else:
+                    log.info(json.dumps(result))
 
-        if len(result['errors']) > 0:
-            failed_tests.append(result)
+                if len(result['errors']) > 0:
+                    failed_tests.append(result)
 
-    if len(failed_tests) > 0:
-        send_email(failed_tests, config['smtpServer'], config['mailSender'], config['mailRecipients'])
+        if len(failed_tests) > 0:
+            send_email(failed_tests, config['smtpServer'], config['mailSender'], config['mailRecipients'])
+    finally:
+        log_listener.stop()